@@ -1,16 +1,21 @@
 import ollama
+import os
 import subprocess
 import sys
+from typing import Final
+
+# One client for the whole run so the HTTP connection is reused between steps
+client = ollama.Client(host=os.environ.get("OLLAMA_HOST", "http://localhost:11434"))
 
 # Define available tools
 def run_shell_command(command):
     """Execute a shell command and return its output."""
     try:
-        result = subprocess.run(command, shell=True, capture_output=True, text=True)
+        result = subprocess.run(command, shell=True, capture_output=True)
         if result.returncode == 0:
-            return result.stdout.strip()
+            return result.stdout.decode('utf-8', 'replace').strip()
         else:
-            return f"Error: {result.stderr.strip()}"
+            return f"Error: {result.stderr.decode('utf-8', 'replace').strip()}"
     except Exception as e:
         return f"Exception: {str(e)}"
 
@@ -18,8 +23,18 @@ TOOLS = {
     "run_shell_command": run_shell_command
 }
 
-# System prompt for ReAct pattern
-SYSTEM_PROMPT = """
+# Longest observation, in characters, that is added to history
+MAX_OBSERVATION = 8192
+
+def truncate_observation(observation):
+    """Cap observation at MAX_OBSERVATION characters, noting how much was cut."""
+    if len(observation) <= MAX_OBSERVATION:
+        return observation
+    return observation[:MAX_OBSERVATION] + f"\n... [truncated {len(observation) - MAX_OBSERVATION} characters]"
+
+# System prompt for ReAct pattern, sent byte-for-byte identical on every call so the
+# server can reuse its cached prefix; per-turn context goes into later messages
+SYSTEM_PROMPT: Final = """
 You are an AI agent that solves tasks iteratively using Reasoning and Acting (ReAct).
 For each step:
 - Thought: Reason step-by-step about what to do next.
@@ -29,9 +44,18 @@ For each step:
 Do not repeat actions unnecessarily. Stop when the query is solved.
 """
 
+# Number of most recent exchanges sent to the model alongside the system prompt and query
+HISTORY_WINDOW = 6
+
+def window_history(history, k=HISTORY_WINDOW):
+    """Return the system prompt, the original query and the last k exchanges of history."""
+    if len(history) <= 2 + 2 * k:
+        return history
+    return history[:2] + history[-2 * k:]
+
 def get_llm_response(history):
     """Query Ollama with conversation history."""
-    response = ollama.chat(model='llama3.1:8b', messages=history)  # Change model if needed
+    response = client.chat(model='llama3.1:8b', messages=window_history(history))  # Change model if needed
     return response['message']['content']
 
 def parse_output(output):
@@ -83,7 +107,7 @@ def run_agent(query, max_steps=10):
         if action:
             tool_name, arg = action
             if tool_name in TOOLS:
-                observation = TOOLS[tool_name](arg)
+                observation = truncate_observation(TOOLS[tool_name](arg))
                 print("Action:", action)
                 print("Observation:", observation)
                 # Add to history
@@ -1,17 +1,21 @@
 import ollama
+import os
 import subprocess
 import sys
-import re
+from typing import Final
+
+# One client for the whole run so the HTTP connection is reused between steps
+client = ollama.Client(host=os.environ.get("OLLAMA_HOST", "http://localhost:11434"))
 
 # Define available tools
 def run_shell_command(command):
     """Execute a shell command and return its output."""
     try:
-        result = subprocess.run(command, shell=True, capture_output=True, text=True, timeout=30)
+        result = subprocess.run(command, shell=True, capture_output=True, timeout=30)
         if result.returncode == 0:
-            return result.stdout.strip()
+            return result.stdout.decode('utf-8', 'replace').strip()
         else:
-            return f"Error: {result.stderr.strip()}"
+            return f"Error: {result.stderr.decode('utf-8', 'replace').strip()}"
     except subprocess.TimeoutExpired:
         return "action execution failed with timeout"
     except Exception as e:
@@ -21,8 +25,18 @@ TOOLS = {
     "run_shell_command": run_shell_command
 }
 
-# System prompt for ReAct pattern
-SYSTEM_PROMPT = """
+# Longest observation, in characters, that is added to history
+MAX_OBSERVATION = 8192
+
+def truncate_observation(observation):
+    """Cap observation at MAX_OBSERVATION characters, noting how much was cut."""
+    if len(observation) <= MAX_OBSERVATION:
+        return observation
+    return observation[:MAX_OBSERVATION] + f"\n... [truncated {len(observation) - MAX_OBSERVATION} characters]"
+
+# System prompt for ReAct pattern, sent byte-for-byte identical on every call so the
+# server can reuse its cached prefix; per-turn context goes into later messages
+SYSTEM_PROMPT: Final = """
 You are an AI agent that solves tasks iteratively using Reasoning and Acting (ReAct).
 Your response MUST be in the following format for each step:
 |Thought:| [Your reasoning process here]
@@ -43,31 +57,86 @@ Do not repeat actions unnecessarily. Stop when the query is solved.
 Do not try to install additional software on the computer where you are being executed.
 """
 
-def get_llm_response(history):
-    """Query Ollama with conversation history and stream the response."""
-    stream = ollama.chat(model='llama3.1:8b', messages=history, stream=True)
+# Number of most recent exchanges sent to the model alongside the system prompt and query
+HISTORY_WINDOW = 6
+
+def window_history(history, k=HISTORY_WINDOW):
+    """Return the system prompt, the original query and the last k exchanges of history."""
+    if len(history) <= 2 + 2 * k:
+        return history
+    return history[:2] + history[-2 * k:]
+
+def get_llm_response(history, stop_predicate=None):
+    """Query Ollama with conversation history and stream the response.
+
+    If stop_predicate is given, it is called with the text received so far and
+    returns None or the offset where the response ends; the stream is then closed,
+    aborting generation, and only the text before that offset is ever yielded.
+    """
+    stream = client.chat(model='llama3.1:8b', messages=window_history(history), stream=True)
+    buffer = ""
+    sent = 0
     for chunk in stream:
-        yield chunk['message']['content']
+        content = chunk['message']['content']
+        if not stop_predicate:
+            yield content
+            continue
+        buffer += content
+        # Tags end with '|', so only chunks containing one can complete a step
+        cut = stop_predicate(buffer) if '|' in content else None
+        if cut is not None:
+            if cut > sent:
+                yield buffer[sent:cut]
+            stream.close()
+            return
+        # Hold back a trailing partial tag: if it completes into the cut, it must not have been yielded
+        safe = buffer.rfind('|', sent)
+        if safe < 0 or not any(tag.startswith(buffer[safe:]) for tag in _TAGS):
+            safe = len(buffer)
+        if safe > sent:
+            yield buffer[sent:safe]
+            sent = safe
+    if sent < len(buffer):
+        yield buffer[sent:]
 
-import re
+_TAGS = ("|Thought:|", "|Action:|", "|Final Answer:|")
 
 def parse_output(output):
     """Parse LLM output for Thought, Action, or Final Answer."""
-    thought_match = re.search(r"\|Thought:\|(.*?)(?:\|Action:\||\|Final Answer:\||$)", output, re.DOTALL)
-    action_match = re.search(r"\|Action:\|(.*?)(?:\|Thought:\||\|Final Answer:\||$)", output, re.DOTALL)
-    final_answer_match = re.search(r"\|Final Answer:\|(.*?)(?:\|Thought:\||\|Action:\||$)", output, re.DOTALL)
+    # Every tag contains '|', so untagged output has nothing to parse
+    if "|" not in output:
+        return "", None, ""
 
-    thought = thought_match.group(1).strip() if thought_match else ""
-    action_str = action_match.group(1).strip() if action_match else ""
-    final_answer = final_answer_match.group(1).strip() if final_answer_match else ""
+    # Each section starts at the first occurrence of its tag and ends at the nearest tag after it
+    sections = {}
+    for tag in _TAGS:
+        start = output.find(tag)
+        if start < 0:
+            continue
+        start += len(tag)
+        ends = [offset for offset in (output.find(other, start) for other in _TAGS) if offset >= 0]
+        sections[tag] = output[start:min(ends, default=len(output))].strip()
+
+    thought = sections.get("|Thought:|", "")
+    action_str = sections.get("|Action:|", "")
+    final_answer = sections.get("|Final Answer:|", "")
 
     action = None
-    if action_str and ':' in action_str:
-        tool, arg = action_str.split(':', 1)
+    tool, separator, arg = action_str.partition(':')
+    if separator:
         action = (tool.strip(), arg.strip())
 
     return thought, action, final_answer
 
+def step_complete(buffer):
+    """Return the offset of the first tag opening a new section after an Action or Final Answer, else None."""
+    cuts = []
+    for tag in ("|Action:|", "|Final Answer:|"):
+        start = buffer.find(tag)
+        if start >= 0:
+            cuts.extend(offset for offset in (buffer.find(other, start + len(tag)) for other in _TAGS) if offset >= 0)
+    return min(cuts, default=None)
+
 def run_agent(query, max_steps=10):
     """Main agent loop implementing ReAct."""
     history = [
@@ -79,12 +148,13 @@ def run_agent(query, max_steps=10):
         print(f"\nStep {step + 1}:")
         
         # Reason: Get LLM response
-        full_response = ""
+        parts = []
         print("LLM Output:", end="", flush=True)
-        for chunk in get_llm_response(history):
+        for chunk in get_llm_response(history, step_complete):
             print(chunk, end="", flush=True)
-            full_response += chunk
+            parts.append(chunk)
         print()
+        full_response = "".join(parts)
 
         # Parse
         thought, action, final_answer = parse_output(full_response)
@@ -99,7 +169,7 @@ def run_agent(query, max_steps=10):
         if action:
             tool_name, arg = action
             if tool_name in TOOLS:
-                observation = TOOLS[tool_name](arg)
+                observation = truncate_observation(TOOLS[tool_name](arg))
                 print("Action:", action)
                 print("Observation:", observation)
                 # Add to history
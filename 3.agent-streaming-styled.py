@@ -1,23 +1,40 @@
 import ollama
+import os
 import subprocess
 import sys
 import re
+from contextlib import nullcontext
+from typing import Final
 from rich.console import Console
 from rich.panel import Panel
 from rich.syntax import Syntax
 from rich.rule import Rule
 
 console = Console()
+# One client for the whole run so the HTTP connection is reused between steps
+client = ollama.Client(host=os.environ.get("OLLAMA_HOST", "http://localhost:11434"))
+
+# Set AGENTTURNS_QUIET=1 to skip decorative output (panels, rules, spinners) for batch or benchmark runs
+QUIET = bool(os.environ.get("AGENTTURNS_QUIET"))
+
+def show(renderable):
+    """Print a decorative renderable unless running quiet."""
+    if not QUIET:
+        console.print(renderable)
+
+def status(message):
+    """Return a spinner context for message, or a no-op one when running quiet."""
+    return nullcontext() if QUIET else console.status(message)
 
 # Define available tools
 def run_shell_command(command):
     """Execute a shell command and return its output."""
     try:
-        result = subprocess.run(command, shell=True, capture_output=True, text=True, timeout=30)
+        result = subprocess.run(command, shell=True, capture_output=True, timeout=30)
         if result.returncode == 0:
-            return result.stdout.strip()
+            return result.stdout.decode('utf-8', 'replace').strip()
         else:
-            return f"Error: {result.stderr.strip()}"
+            return f"Error: {result.stderr.decode('utf-8', 'replace').strip()}"
     except subprocess.TimeoutExpired:
         return "action execution failed with timeout"
     except Exception as e:
@@ -27,8 +44,18 @@ TOOLS = {
     "run_shell_command": run_shell_command
 }
 
-# System prompt for ReAct pattern
-SYSTEM_PROMPT = """
+# Longest observation, in characters, that is added to history
+MAX_OBSERVATION = 8192
+
+def truncate_observation(observation):
+    """Cap observation at MAX_OBSERVATION characters, noting how much was cut."""
+    if len(observation) <= MAX_OBSERVATION:
+        return observation
+    return observation[:MAX_OBSERVATION] + f"\n... [truncated {len(observation) - MAX_OBSERVATION} characters]"
+
+# System prompt for ReAct pattern, sent byte-for-byte identical on every call so the
+# server can reuse its cached prefix; per-turn context goes into later messages
+SYSTEM_PROMPT: Final = """
 You are an AI agent that solves tasks iteratively using Reasoning and Acting (ReAct).
 Your response MUST be in the following format for each step:
 |Thought:| [Your reasoning process here]
@@ -49,14 +76,21 @@ Do not repeat actions unnecessarily. Stop when the query is solved.
 Do not try to install additional software on the computer where you are being executed.
 """
 
+# Number of most recent exchanges sent to the model alongside the system prompt and query
+HISTORY_WINDOW = 6
+
+def window_history(history, k=HISTORY_WINDOW):
+    """Return the system prompt, the original query and the last k exchanges of history."""
+    if len(history) <= 2 + 2 * k:
+        return history
+    return history[:2] + history[-2 * k:]
+
 def get_llm_response(history):
     """Query Ollama with conversation history and stream the response."""
-    stream = ollama.chat(model='llama3.1:8b', messages=history, stream=True)
+    stream = client.chat(model='llama3.1:8b', messages=window_history(history), stream=True)
     for chunk in stream:
         yield chunk['message']['content']
 
-import re
-
 def parse_output(output):
     """Parse LLM output for Thought, Action, or Final Answer."""
     thought_match = re.search(r"\|Thought:\|(.*?)(?:\|Action:\||\|Final Answer:\||$)", output, re.DOTALL)
@@ -74,8 +108,6 @@ def parse_output(output):
 
     return thought, action, final_answer
 
-from rich.rule import Rule
-
 def run_agent(query, max_steps=10):
     """Main agent loop implementing ReAct."""
     history = [
@@ -84,38 +116,38 @@ def run_agent(query, max_steps=10):
     ]
     
     for step in range(max_steps):
-        console.print(Rule(f"[bold blue]Step {step + 1}"))
+        show(Rule(f"[bold blue]Step {step + 1}"))
         
         # Reason: Get LLM response
         full_response = ""
-        with console.status("[bold green]Thinking..."):
+        with status("[bold green]Thinking..."):
             for chunk in get_llm_response(history):
                 full_response += chunk
         
-        console.print(Panel(full_response, title="LLM Output", border_style="green", expand=False))
+        show(Panel(full_response, title="LLM Output", border_style="green", expand=False))
 
         # Parse
         thought, action, final_answer = parse_output(full_response)
         
         if thought:
-            console.print(Panel(thought, title="Thought", border_style="yellow", expand=False))
+            show(Panel(thought, title="Thought", border_style="yellow", expand=False))
         
         if final_answer:
-            console.print(Panel(final_answer, title="Final Answer", border_style="sky_blue1", expand=False))
+            show(Panel(final_answer, title="Final Answer", border_style="sky_blue1", expand=False))
             return final_answer
         
         if action:
             tool_name, arg = action
             if tool_name in TOOLS:
                 syntax = Syntax(arg, "bash", theme="monokai", line_numbers=True)
-                console.print(Panel(syntax, title=f"Action: {tool_name}", border_style="dark_orange", expand=False))
-                observation = TOOLS[tool_name](arg)
-                console.print(Panel(observation, title="Observation", border_style="green", expand=False))
+                show(Panel(syntax, title=f"Action: {tool_name}", border_style="dark_orange", expand=False))
+                observation = truncate_observation(TOOLS[tool_name](arg))
+                show(Panel(observation, title="Observation", border_style="green", expand=False))
                 # Add to history
                 history.append({"role": "assistant", "content": full_response})
                 history.append({"role": "user", "content": f"Observation: {observation}"})
             else:
-                console.print(Panel(f"Unknown tool: {tool_name}", title="Error", border_style="bold red", expand=False))
+                show(Panel(f"Unknown tool: {tool_name}", title="Error", border_style="bold red", expand=False))
         else:
             # No action or final, continue
             history.append({"role": "assistant", "content": full_response})
@@ -126,7 +158,7 @@ if __name__ == "__main__":
     if len(sys.argv) > 1:
         query = sys.argv[1]
         result = run_agent(query)
-        console.print(Rule("[bold magenta]Result"))
+        show(Rule("[bold magenta]Result"))
         console.print(result)
     else:
         print("Usage: python agent-streaming-styled.py 'your query'")
\ No newline at end of file
@@ -1,24 +1,61 @@
 import ollama
+import os
 import subprocess
 import sys
-import re
+from contextlib import nullcontext
+from functools import lru_cache
+from typing import Final
 from rich.console import Console
 from rich.panel import Panel
 from rich.syntax import Syntax
 from rich.rule import Rule
-from rich.progress import Progress
 
 console = Console()
+# One client for the whole run so the HTTP connection is reused between steps
+client = ollama.Client(host=os.environ.get("OLLAMA_HOST", "http://localhost:11434"))
+
+# Set AGENTTURNS_QUIET=1 to skip decorative output (panels, rules, spinners) for batch or benchmark runs
+QUIET = bool(os.environ.get("AGENTTURNS_QUIET"))
+
+def show(renderable):
+    """Print a decorative renderable unless running quiet."""
+    if not QUIET:
+        console.print(renderable)
+
+def status(message):
+    """Return a spinner context for message, or a no-op one when running quiet."""
+    return nullcontext() if QUIET else console.status(message)
+
+# tiktoken is optional; without it token counts fall back to a characters / 4 estimate.
+# cl100k_base is not the model's own vocabulary but tracks it far closer than the estimate.
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+@lru_cache(maxsize=None)
+def get_encoding():
+    """Load the tiktoken encoding on first use, or return None if it is unavailable.
+
+    On a cold cache tiktoken downloads the vocabulary, so this is kept out of import time.
+    """
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        show(Panel(f"Could not load tiktoken encoding, estimating tokens instead: {e}", title="Error", border_style="bold red"))
+        return None
 
 # Define available tools
 def run_shell_command(command):
     """Execute a shell command and return its output."""
     try:
-        result = subprocess.run(command, shell=True, capture_output=True, text=True, timeout=30)
+        result = subprocess.run(command, shell=True, capture_output=True, timeout=30)
         if result.returncode == 0:
-            return result.stdout.strip()
+            return result.stdout.decode('utf-8', 'replace').strip()
         else:
-            return f"Error: {result.stderr.strip()}"
+            return f"Error: {result.stderr.decode('utf-8', 'replace').strip()}"
     except subprocess.TimeoutExpired:
         return "action execution failed with timeout"
     except Exception as e:
@@ -28,8 +65,18 @@ TOOLS = {
     "run_shell_command": run_shell_command
 }
 
-# System prompt for ReAct pattern
-SYSTEM_PROMPT = """
+# Longest observation, in characters, that is added to history
+MAX_OBSERVATION = 8192
+
+def truncate_observation(observation):
+    """Cap observation at MAX_OBSERVATION characters, noting how much was cut."""
+    if len(observation) <= MAX_OBSERVATION:
+        return observation
+    return observation[:MAX_OBSERVATION] + f"\n... [truncated {len(observation) - MAX_OBSERVATION} characters]"
+
+# System prompt for ReAct pattern, sent byte-for-byte identical on every call so the
+# server can reuse its cached prefix; per-turn context goes into later messages
+SYSTEM_PROMPT: Final = """
 You are an AI agent that solves tasks iteratively using Reasoning and Acting (ReAct).
 Your response MUST be in the following format for each step:
 |Thought:| [Your reasoning process here]
@@ -50,40 +97,157 @@ Do not repeat actions unnecessarily. Stop when the query is solved.
 Do not try to install additional software on the computer where you are being executed.
 """
 
-def get_llm_response(history):
-    """Query Ollama with conversation history and stream the response."""
-    stream = ollama.chat(model='llama3.1:8b', messages=history, stream=True)
+# Number of most recent exchanges sent to the model alongside the system prompt and query
+HISTORY_WINDOW = 6
+
+# Marks the message compact_history puts right after the original query
+SUMMARY_PREFIX = "Summary of prior work: "
+
+def window_history(history, k=HISTORY_WINDOW):
+    """Return the system prompt, the original query, any history summary and the last k exchanges of history."""
+    pinned = 3 if len(history) > 2 and history[2]['content'].startswith(SUMMARY_PREFIX) else 2
+    if len(history) <= pinned + 2 * k:
+        return history
+    return history[:pinned] + history[-2 * k:]
+
+# Context length requested from the server on every call; without it Ollama runs with its own small
+# default and silently truncates the prompt, whatever the model's trained context length
+NUM_CTX = 16384
+
+def get_llm_response(history, stop_predicate=None, num_ctx=NUM_CTX):
+    """Query Ollama with conversation history and stream the response.
+
+    All calls must use the same num_ctx: a different value makes the server reload the model.
+
+    If stop_predicate is given, it is called with the text received so far and
+    returns None or the offset where the response ends; the stream is then closed,
+    aborting generation, and only the text before that offset is ever yielded.
+    """
+    stream = client.chat(model='llama3.1:8b', messages=window_history(history), options={'num_ctx': num_ctx}, stream=True)
+    buffer = ""
+    sent = 0
     for chunk in stream:
-        yield chunk['message']['content']
+        content = chunk['message']['content']
+        if not stop_predicate:
+            yield content
+            continue
+        buffer += content
+        # Tags end with '|', so only chunks containing one can complete a step
+        cut = stop_predicate(buffer) if '|' in content else None
+        if cut is not None:
+            if cut > sent:
+                yield buffer[sent:cut]
+            stream.close()
+            return
+        # Hold back a trailing partial tag: if it completes into the cut, it must not have been yielded
+        safe = buffer.rfind('|', sent)
+        if safe < 0 or not any(tag.startswith(buffer[safe:]) for tag in _TAGS):
+            safe = len(buffer)
+        if safe > sent:
+            yield buffer[sent:safe]
+            sent = safe
+    if sent < len(buffer):
+        yield buffer[sent:]
+
+_TAGS = ("|Thought:|", "|Action:|", "|Final Answer:|")
 
 def parse_output(output):
     """Parse LLM output for Thought, Action, or Final Answer."""
-    thought_match = re.search(r"\|Thought:\|(.*?)(?:\|Action:\||\|Final Answer:\||$)", output, re.DOTALL)
-    action_match = re.search(r"\|Action:\|(.*?)(?:\|Thought:\||\|Final Answer:\||$)", output, re.DOTALL)
-    final_answer_match = re.search(r"\|Final Answer:\|(.*?)(?:\|Thought:\||\|Action:\||$)", output, re.DOTALL)
+    # Every tag contains '|', so untagged output has nothing to parse
+    if "|" not in output:
+        return "", None, ""
+
+    # Each section starts at the first occurrence of its tag and ends at the nearest tag after it
+    sections = {}
+    for tag in _TAGS:
+        start = output.find(tag)
+        if start < 0:
+            continue
+        start += len(tag)
+        ends = [offset for offset in (output.find(other, start) for other in _TAGS) if offset >= 0]
+        sections[tag] = output[start:min(ends, default=len(output))].strip()
 
-    thought = thought_match.group(1).strip() if thought_match else ""
-    action_str = action_match.group(1).strip() if action_match else ""
-    final_answer = final_answer_match.group(1).strip() if final_answer_match else ""
+    thought = sections.get("|Thought:|", "")
+    action_str = sections.get("|Action:|", "")
+    final_answer = sections.get("|Final Answer:|", "")
 
     action = None
-    if action_str and ':' in action_str:
-        tool, arg = action_str.split(':', 1)
+    tool, separator, arg = action_str.partition(':')
+    if separator:
         action = (tool.strip(), arg.strip())
 
     return thought, action, final_answer
 
+def step_complete(buffer):
+    """Return the offset of the first tag opening a new section after an Action or Final Answer, else None."""
+    cuts = []
+    for tag in ("|Action:|", "|Final Answer:|"):
+        start = buffer.find(tag)
+        if start >= 0:
+            cuts.extend(offset for offset in (buffer.find(other, start + len(tag)) for other in _TAGS) if offset >= 0)
+    return min(cuts, default=None)
+
 def get_context_window_size(model_name='llama3.1:8b'):
-    """Get the context window size of the model."""
+    """Get the context window requests run with: NUM_CTX, capped at the model's trained context length."""
     try:
-        result = subprocess.run(f"ollama show {model_name}", shell=True, capture_output=True, text=True)
-        if result.returncode == 0:
-            for line in result.stdout.split('\n'):
-                if 'context length' in line:
-                    return int(line.split()[-1])
+        info = client.show(model_name)
+        # Older clients return a plain dict keyed 'model_info', newer ones a model with 'modelinfo'
+        model_info = info.get('modelinfo') or info.get('model_info') or {}
+        # The key is prefixed with the architecture, e.g. 'llama.context_length'
+        for key, value in model_info.items():
+            if key.endswith('.context_length'):
+                return min(NUM_CTX, int(value))
     except Exception as e:
-        console.print(Panel(f"Could not get context window size: {e}", title="Error", border_style="bold red"))
-        return None
+        show(Panel(f"Could not get context window size: {e}", title="Error", border_style="bold red"))
+    return NUM_CTX
+
+@lru_cache(maxsize=4096)
+def count_tokens(text):
+    """Count the tokens in text, caching the result per distinct string."""
+    encoding = get_encoding()
+    if encoding is None:
+        return len(text) // 4 # Rough estimation
+    # Tool output may contain special-token text like <|endoftext|>; count it as ordinary text
+    return len(encoding.encode_ordinary(text))
+
+# Share of the context window after which older turns get summarized
+COMPACT_THRESHOLD = 0.5
+# Number of most recent messages that are never summarized
+COMPACT_KEEP_RECENT = 4
+
+def usage_bar(completed, total, width=40):
+    """Return a one-line bar showing completed out of total."""
+    filled = min(width, round(width * completed / total))
+    return "█" * filled + "░" * (width - filled)
+
+def context_tokens(history):
+    """Count the tokens of the messages actually sent to the model."""
+    return sum(count_tokens(message['content']) for message in window_history(history))
+
+def compact_history(history, num_ctx):
+    """Replace older turns with a summary once the context sent to the model outgrows COMPACT_THRESHOLD of num_ctx."""
+    max_tokens = int(num_ctx * COMPACT_THRESHOLD)
+    # Turns that already fell out of the window are not seen by the model, so only sent ones are summarized;
+    # a previous summary is among them and gets folded into the new one
+    sent = window_history(history)
+    old_turns = sent[2:-COMPACT_KEEP_RECENT]
+    if context_tokens(history) <= max_tokens or len(old_turns) < 2:
+        return
+    # If the prompt, query and recent turns alone exceed the budget, no summary can help;
+    # trying anyway would request a new one on every step
+    kept = sent[:2] + sent[-COMPACT_KEEP_RECENT:]
+    if sum(count_tokens(message['content']) for message in kept) >= max_tokens:
+        return
+
+    transcript = "\n".join(f"{message['role']}: {message['content']}" for message in old_turns)
+    summary_request = [{"role": "user", "content": f"Summarize the following ReAct trace preserving facts, decisions, tool outputs:\n{transcript}"}]
+    with status("[bold green]Compacting history..."):
+        summary = "".join(get_llm_response(summary_request, num_ctx=num_ctx))
+    show(Panel(summary, title="History Summary", border_style="cyan", expand=False))
+
+    # Keep the system prompt and the original query, replace everything up to the recent turns.
+    # The summary is a user message so the system prefix stays untouched.
+    history[2:-COMPACT_KEEP_RECENT] = [{"role": "user", "content": SUMMARY_PREFIX + summary}]
 
 def run_agent(query, max_steps=10):
     """Main agent loop implementing ReAct."""
@@ -91,75 +255,65 @@ def run_agent(query, max_steps=10):
         {"role": "system", "content": SYSTEM_PROMPT},
         {"role": "user", "content": query}
     ]
-    
     context_window_size = get_context_window_size()
 
     for step in range(max_steps):
-        console.print(Rule(f"[bold blue]Step {step + 1}"))
+        show(Rule(f"[bold blue]Step {step + 1}"))
         
         # Calculate context utilization
-        if context_window_size:
-            total_chars = sum(len(message['content']) for message in history)
-            estimated_tokens = int(total_chars / 4) # Rough estimation
-            percentage = (estimated_tokens / context_window_size) * 100
-            console.print(f"[cyan]Context Utilization: {estimated_tokens} / {context_window_size} tokens ({percentage:.2f}%)")
-            with Progress() as progress:
-                task = progress.add_task("", total=context_window_size)
-                progress.update(task, advance=estimated_tokens)
+        compact_history(history, context_window_size)
+        # Counts are cached per message text, so only newly added messages get tokenized
+        total_tokens = context_tokens(history)
+        percentage = (total_tokens / context_window_size) * 100
+        show(f"[cyan]Context Utilization: {total_tokens} / {context_window_size} tokens ({percentage:.2f}%)")
+        show(f"[cyan]{usage_bar(total_tokens, context_window_size)}")
 
         # Reason: Get LLM response
-        full_response = ""
-        with console.status("[bold green]Thinking..."):
-            for chunk in get_llm_response(history):
-                full_response += chunk
+        with status("[bold green]Thinking..."):
+            full_response = "".join(get_llm_response(history, step_complete, context_window_size))
         
-        console.print(Panel(full_response, title="LLM Output", border_style="green", expand=False))
+        show(Panel(full_response, title="LLM Output", border_style="green", expand=False))
 
         # Parse
         thought, action, final_answer = parse_output(full_response)
         
         if thought:
-            console.print(Panel(thought, title="Thought", border_style="yellow", expand=False))
+            show(Panel(thought, title="Thought", border_style="yellow", expand=False))
         
         if final_answer:
-            console.print(Panel(final_answer, title="Final Answer", border_style="sky_blue1", expand=False))
-            return final_answer, history
+            show(Panel(final_answer, title="Final Answer", border_style="sky_blue1", expand=False))
+            return final_answer, history, context_tokens(history)
         
         if action:
             tool_name, arg = action
             if tool_name in TOOLS:
                 syntax = Syntax(arg, "bash", theme="monokai", line_numbers=True)
-                console.print(Panel(syntax, title=f"Action: {tool_name}", border_style="dark_orange", expand=False))
-                observation = TOOLS[tool_name](arg)
-                console.print(Panel(observation, title="Observation", border_style="green", expand=False))
+                show(Panel(syntax, title=f"Action: {tool_name}", border_style="dark_orange", expand=False))
+                observation = truncate_observation(TOOLS[tool_name](arg))
+                show(Panel(observation, title="Observation", border_style="green", expand=False))
                 # Add to history
                 history.append({"role": "assistant", "content": full_response})
                 history.append({"role": "user", "content": f"Observation: {observation}"})
             else:
-                console.print(Panel(f"Unknown tool: {tool_name}", title="Error", border_style="bold red", expand=False))
+                show(Panel(f"Unknown tool: {tool_name}", title="Error", border_style="bold red", expand=False))
         else:
             # No action or final, continue
             history.append({"role": "assistant", "content": full_response})
     
-    return "Max steps reached without final answer.", history
+    return "Max steps reached without final answer.", history, context_tokens(history)
 
 if __name__ == "__main__":
     if len(sys.argv) > 1:
         query = sys.argv[1]
-        result, history = run_agent(query)
-        console.print(Rule("[bold magenta]Result"))
+        result, history, total_tokens = run_agent(query)
+        show(Rule("[bold magenta]Result"))
         console.print(result)
 
         context_window_size = get_context_window_size()
-        if context_window_size:
-            total_chars = sum(len(message['content']) for message in history)
-            estimated_tokens = int(total_chars / 4) # Rough estimation
-            percentage = (estimated_tokens / context_window_size) * 100
-            console.print(Rule("[bold cyan]Final Context Utilization"))
-            console.print(f"[cyan]{estimated_tokens} / {context_window_size} tokens ({percentage:.2f}%)")
-            with Progress() as progress:
-                task = progress.add_task("", total=context_window_size)
-                progress.update(task, advance=estimated_tokens)
+        percentage = (total_tokens / context_window_size) * 100
+        show(Rule("[bold cyan]Final Context Utilization"))
+        show(f"[cyan]{total_tokens} / {context_window_size} tokens ({percentage:.2f}%)")
+        show(f"[cyan]{usage_bar(total_tokens, context_window_size)}")
 
     else:
         print("Usage: python agent-streaming-styled-context.py 'your query'")
\ No newline at end of file
@@ -1,23 +1,46 @@
 import ollama
+import os
+import asyncio
 import subprocess
 import sys
 import re
+import shlex
+from contextlib import nullcontext
+from typing import Final
 from rich.console import Console
 from rich.panel import Panel
 from rich.syntax import Syntax
 from rich.rule import Rule
 
 console = Console()
+# Async client so independent requests (e.g. the safety check) can be in flight together
+client = ollama.AsyncClient(host=os.environ.get("OLLAMA_HOST", "http://localhost:11434"))
+
+# Set AGENTTURNS_QUIET=1 to skip decorative output (panels, rules, spinners) for batch or benchmark runs
+QUIET = bool(os.environ.get("AGENTTURNS_QUIET"))
+
+def show(renderable):
+    """Print a decorative renderable unless running quiet."""
+    if not QUIET:
+        console.print(renderable)
+
+def status(message):
+    """Return a spinner context for message, or a no-op one when running quiet."""
+    return nullcontext() if QUIET else console.status(message)
 
 # Define available tools
 def run_shell_command(command):
     """Execute a shell command and return its output."""
     try:
-        result = subprocess.run(command, shell=True, capture_output=True, text=True, timeout=30)
+        # Plain read-only commands run directly, without a /bin/sh in between
+        if is_read_only_command(command) and not SHELL_EXPANSIONS.search(command):
+            result = subprocess.run(shlex.split(command), capture_output=True, timeout=30)
+        else:
+            result = subprocess.run(command, shell=True, capture_output=True, timeout=30)
         if result.returncode == 0:
-            return result.stdout.strip()
+            return result.stdout.decode('utf-8', 'replace').strip()
         else:
-            return f"Error: {result.stderr.strip()}"
+            return f"Error: {result.stderr.decode('utf-8', 'replace').strip()}"
     except subprocess.TimeoutExpired:
         return "action execution failed with timeout"
     except Exception as e:
@@ -27,8 +50,18 @@ TOOLS = {
     "run_shell_command": run_shell_command
 }
 
-# System prompt for ReAct pattern
-SYSTEM_PROMPT = '''
+# Longest observation, in characters, that is added to history
+MAX_OBSERVATION = 8192
+
+def truncate_observation(observation):
+    """Cap observation at MAX_OBSERVATION characters, noting how much was cut."""
+    if len(observation) <= MAX_OBSERVATION:
+        return observation
+    return observation[:MAX_OBSERVATION] + f"\n... [truncated {len(observation) - MAX_OBSERVATION} characters]"
+
+# System prompt for ReAct pattern, sent byte-for-byte identical on every call so the
+# server can reuse its cached prefix; per-turn context goes into later messages
+SYSTEM_PROMPT: Final = '''
 You are an AI agent that solves tasks iteratively using Reasoning and Acting (ReAct).
 Your response MUST be in the following format for each step:
 |Thought:| [Your reasoning process here]
@@ -49,53 +82,150 @@ Do not repeat actions unnecessarily. Stop when the query is solved.
 Do not try to install additional software on the computer where you are being executed.
 '''
 
-def get_llm_response(history):
-    """Query Ollama with conversation history and stream the response."""
-    stream = ollama.chat(model='gemma3:12b', messages=history, stream=True) 
-    for chunk in stream: 
-        yield chunk['message']['content']
+VERIFICATION_PROMPT: Final = "Please review your final answer above. Is this a good answer given the original request? If you have a better answer, respond with |Better Answer:| <text>, otherwise respond OK."
 
-import re
+# Number of most recent exchanges sent to the model alongside the system prompt and query
+HISTORY_WINDOW = 6
+
+def window_history(history, k=HISTORY_WINDOW):
+    """Return the system prompt, the original query and the last k exchanges of history."""
+    if len(history) <= 2 + 2 * k:
+        return history
+    return history[:2] + history[-2 * k:]
+
+async def get_llm_response(history, stop_predicate=None):
+    """Query Ollama with conversation history and stream the response.
+
+    If stop_predicate is given, it is called with the text received so far and
+    returns None or the offset where the response ends; the stream is then closed,
+    aborting generation, and only the text before that offset is ever yielded.
+    """
+    stream = await client.chat(model='gemma3:12b', messages=window_history(history), stream=True)
+    buffer = ""
+    sent = 0
+    async for chunk in stream:
+        content = chunk['message']['content']
+        if not stop_predicate:
+            yield content
+            continue
+        buffer += content
+        # Tags end with '|', so only chunks containing one can complete a step
+        cut = stop_predicate(buffer) if '|' in content else None
+        if cut is not None:
+            if cut > sent:
+                yield buffer[sent:cut]
+            await stream.aclose()
+            return
+        # Hold back a trailing partial tag: if it completes into the cut, it must not have been yielded
+        safe = buffer.rfind('|', sent)
+        if safe < 0 or not any(tag.startswith(buffer[safe:]) for tag in _TAGS):
+            safe = len(buffer)
+        if safe > sent:
+            yield buffer[sent:safe]
+            sent = safe
+    if sent < len(buffer):
+        yield buffer[sent:]
+
+async def get_full_llm_response(history, stop_predicate=None):
+    """Collect the complete streamed response for history."""
+    return "".join([chunk async for chunk in get_llm_response(history, stop_predicate)])
+
+_TAGS = ("|Thought:|", "|Action:|", "|Final Answer:|")
 
 def parse_output(output):
     """Parse LLM output for Thought, Action, or Final Answer."""
-    thought_match = re.search(r"\|Thought:\|(.*?)\|?\s*(?:\|Action:|\|Final Answer:|$)", output, re.DOTALL)
-    action_match = re.search(r"\|Action:\|(.*?)\|?\s*(?:\|Thought:|\|Final Answer:|$)", output, re.DOTALL)
-    final_answer_match = re.search(r"\|Final Answer:\|(.*?)\|?\s*(?:\|Thought:|\|Action:|$)", output, re.DOTALL)
+    # Every tag contains '|', so untagged output has nothing to parse
+    if "|" not in output:
+        return "", None, ""
+
+    # Each section starts at the first occurrence of its tag and ends at the nearest tag after it
+    sections = {}
+    for tag in _TAGS:
+        start = output.find(tag)
+        if start < 0:
+            continue
+        start += len(tag)
+        ends = [offset for offset in (output.find(other, start) for other in _TAGS) if offset >= 0]
+        sections[tag] = output[start:min(ends, default=len(output))].strip().rstrip("|").strip()
 
-    thought = thought_match.group(1).strip() if thought_match else ""
-    action_str = action_match.group(1).strip() if action_match else ""
-    final_answer = final_answer_match.group(1).strip() if final_answer_match else ""
+    thought = sections.get("|Thought:|", "")
+    action_str = sections.get("|Action:|", "")
+    final_answer = sections.get("|Final Answer:|", "")
 
     action = None
-    if action_str and ':' in action_str:
-        tool, arg = action_str.split(':', 1)
+    tool, separator, arg = action_str.partition(':')
+    if separator:
         action = (tool.strip(), arg.strip())
 
     return thought, action, final_answer
 
-def is_command_safe(command: str) -> bool:
+def step_complete(buffer):
+    """Return where the response ends once a tag follows an Action or Final Answer, else None.
+
+    A following |Thought:| is cut off, but a following |Action:| or |Final Answer:| is kept,
+    so that a response mixing the two is still caught as malformed and retried.
+    """
+    cuts = []
+    for tag in ("|Action:|", "|Final Answer:|"):
+        start = buffer.find(tag)
+        if start < 0:
+            continue
+        for other in _TAGS:
+            offset = buffer.find(other, start + len(tag))
+            if offset >= 0:
+                cuts.append(offset if other == "|Thought:|" else offset + len(other))
+    return min(cuts, default=None)
+
+# Read-only programs that skip the LLM safety check when used without any shell syntax
+READ_ONLY_COMMANDS = frozenset({
+    "ls", "pwd", "cat", "head", "tail", "wc", "grep", "echo", "date",
+    "uname", "whoami", "which", "stat", "df", "du", "ps",
+})
+# Chaining, redirection and substitution that could turn a read-only command into something else
+SHELL_METACHARACTERS = re.compile(r"[;&|`$<>()\n]")
+# Globs, tilde and comments are only interpreted when a shell is involved
+SHELL_EXPANSIONS = re.compile(r"[*?\[\]{}~#]")
+
+def is_read_only_command(command: str) -> bool:
+    """Return True if command runs a single whitelisted read-only program and nothing else."""
+    if SHELL_METACHARACTERS.search(command):
+        return False
+    try:
+        argv = shlex.split(command)
+    except ValueError:
+        return False
+    if not argv or argv[0] not in READ_ONLY_COMMANDS:
+        return False
+    # date can also set the system clock, only allow output formatting
+    if argv[0] == "date":
+        return all(arg.startswith("+") or arg in ("-u", "--utc", "-R") for arg in argv[1:])
+    return True
+
+# Verdicts the model has already given this session, keyed by whitespace-normalized command
+safety_verdicts = {}
+
+async def is_command_safe(command: str) -> bool:
     """Check with the LLM if a command is safe to execute."""
+    if is_read_only_command(command):
+        return True
+    key = " ".join(command.split())
+    if key in safety_verdicts:
+        return safety_verdicts[key]
+
     prompt = f"You have suggested to execute the following command as part of resolving user query: {command}. Is it possible that the command alters user system in an irreversible manner resulting in data loss or system instability. Please answer POSSIBLE or NOT POSSIBLE."
     
     safeguard_history = [{"role": "user", "content": prompt}]
     
-    response = ""
-    with console.status("[bold yellow]Verifying command safety..."):
-        for chunk in get_llm_response(safeguard_history):
-            response += chunk
+    with status("[bold yellow]Verifying command safety..."):
+        response = await get_full_llm_response(safeguard_history)
             
-    console.print(Panel(response, title="Safety Check Response", border_style="yellow", expand=False))
+    show(Panel(response, title="Safety Check Response", border_style="yellow", expand=False))
 
     clean_response = response.strip().upper()
-    if clean_response.startswith("NOT POSSIBLE"):
-        return True
-    else:
-        return False
+    safety_verdicts[key] = clean_response.startswith("NOT POSSIBLE")
+    return safety_verdicts[key]
 
-from rich.rule import Rule
-
-def run_agent(query, max_steps=10):
+async def run_agent(query, max_steps=10):
     """Main agent loop implementing ReAct."""
     history = [
         {"role": "system", "content": SYSTEM_PROMPT},
@@ -103,55 +233,46 @@ def run_agent(query, max_steps=10):
     ]
     
     for step in range(max_steps):
-        console.print(Rule(f"[bold blue]Step {step + 1}"))
+        show(Rule(f"[bold blue]Step {step + 1}"))
         
         # Reason: Get LLM response
-        full_response = ""
-        with console.status("[bold green]Thinking..."):
-            for chunk in get_llm_response(history):
-                full_response += chunk
+        with status("[bold green]Thinking..."):
+            full_response = await get_full_llm_response(history, step_complete)
 
         # Check for malformed response containing both Action and Final Answer
         if "|Action:|" in full_response and "|Final Answer:|" in full_response:
-            console.print(Panel(full_response, title="[bold red]Malformed LLM Output (Retrying)", border_style="red"))
+            show(Panel(full_response, title="[bold red]Malformed LLM Output (Retrying)", border_style="red"))
             continue
         
-        console.print(Panel(full_response, title="LLM Output", border_style="green", expand=False))
+        show(Panel(full_response, title="LLM Output", border_style="green", expand=False))
 
         # Parse
         thought, action, final_answer = parse_output(full_response)
         
         if thought:
-            console.print(Panel(thought, title="Thought", border_style="yellow", expand=False))
+            show(Panel(thought, title="Thought", border_style="yellow", expand=False))
         
         if final_answer:
-            console.print(Panel(final_answer, title="Final Answer", border_style="sky_blue1", expand=False))
+            show(Panel(final_answer, title="Final Answer", border_style="sky_blue1", expand=False))
             
             # Final verification step
-            console.print(Rule("[bold yellow]Final Check"))
-            
-            steps_string = "\n".join([f"{msg['role']}: {msg['content']}" for msg in history])
-            
-            verification_prompt = f"""Original ask was: {query}
-Final answer is: {final_answer}
-Steps are:
-{steps_string}
-
-Is this a good answer given the request? If you have better answer please respond with |Better Answer:| element."""
+            show(Rule("[bold yellow]Final Check"))
             
-            verification_history = [{"role": "user", "content": verification_prompt}]
-            verification_response = ""
-            with console.status("[bold green]Verifying final answer..."):
-                for chunk in get_llm_response(verification_history):
-                    verification_response += chunk
+            # Continue the same conversation so the server can reuse its cached prefix
+            verification_history = history + [
+                {"role": "assistant", "content": full_response},
+                {"role": "user", "content": VERIFICATION_PROMPT}
+            ]
+            with status("[bold green]Verifying final answer..."):
+                verification_response = await get_full_llm_response(verification_history)
             
-            console.print(Panel(verification_response, title="Verification Result", border_style="purple", expand=False))
+            show(Panel(verification_response, title="Verification Result", border_style="purple", expand=False))
             
             # Check for a better answer
             better_answer_match = re.search(r"\|Better Answer:\|(.*?)$", verification_response, re.DOTALL)
             if better_answer_match:
                 better_answer = better_answer_match.group(1).strip()
-                console.print(Panel(better_answer, title="Better Answer", border_style="bold green", expand=False))
+                show(Panel(better_answer, title="Better Answer", border_style="bold green", expand=False))
                 return better_answer
             
             return final_answer
@@ -159,27 +280,32 @@ Is this a good answer given the request? If you have better answer please respon
         if action:
             tool_name, arg = action
             if tool_name in TOOLS:
-                # Safeguard check for shell commands
+                # Safeguard check for shell commands, started before the action is rendered
+                safety_check = None
                 if tool_name == "run_shell_command":
-                    if not is_command_safe(arg):
-                        observation = f"Error: Command '{arg}' was blocked by the safety guard as potentially harmful. The command was not executed."
-                        console.print(Panel(observation, title="Safety Alert", border_style="bold red", expand=False))
-                        history.append({"role": "assistant", "content": full_response})
-                        history.append({"role": "user", "content": f"Observation: {observation}"})
-                        continue # Skip to the next agent step
+                    safety_check = asyncio.create_task(is_command_safe(arg))
+
+                # Highlighting blocks, so it runs in a worker thread while the loop drives the safety request
+                syntax = Syntax(arg, "bash", theme="monokai", line_numbers=True)
+                await asyncio.to_thread(show, Panel(syntax, title=f"Action: {tool_name}", border_style="dark_orange", expand=False))
+
+                if safety_check and not await safety_check:
+                    observation = f"Error: Command '{arg}' was blocked by the safety guard as potentially harmful. The command was not executed."
+                    show(Panel(observation, title="Safety Alert", border_style="bold red", expand=False))
+                    history.append({"role": "assistant", "content": full_response})
+                    history.append({"role": "user", "content": f"Observation: {observation}"})
+                    continue # Skip to the next agent step
                 
                 # If we are here, the command is safe to execute
-                syntax = Syntax(arg, "bash", theme="monokai", line_numbers=True)
-                console.print(Panel(syntax, title=f"Action: {tool_name}", border_style="dark_orange", expand=False))
-                observation = TOOLS[tool_name](arg)
-                console.print(Panel(observation, title="Observation", border_style="green", expand=False))
+                observation = truncate_observation(TOOLS[tool_name](arg))
+                show(Panel(observation, title="Observation", border_style="green", expand=False))
                 # Add to history
                 history.append({"role": "assistant", "content": full_response})
                 history.append({"role": "user", "content": f"Observation: {observation}"})
             else:
                 # Handle unknown tool
                 observation = f"Error: Unknown tool: {tool_name}"
-                console.print(Panel(observation, title="Error", border_style="bold red", expand=False))
+                show(Panel(observation, title="Error", border_style="bold red", expand=False))
                 history.append({"role": "assistant", "content": full_response})
                 history.append({"role": "user", "content": f"Observation: {observation}"})
         else:
@@ -191,8 +317,8 @@ Is this a good answer given the request? If you have better answer please respon
 if __name__ == "__main__":
     if len(sys.argv) > 1:
         query = sys.argv[1]
-        result = run_agent(query)
-        console.print(Rule("[bold magenta]Result"))
+        result = asyncio.run(run_agent(query))
+        show(Rule("[bold magenta]Result"))
         console.print(result)
     else:
         print("Usage: python agent-streaming-styled.py 'your query'")
@@ -1,17 +1,48 @@
 import ollama
-import subprocess
+import os
+import asyncio
 import sys
-import json
+import orjson
 import re
-from rich.console import Console
+import shlex
+import shutil
+import signal
+from rich.console import Console, Group
 from rich.panel import Panel
 from rich.syntax import Syntax
+from rich.text import Text
 from rich.rule import Rule
+from rich.live import Live
+from rich.spinner import Spinner
 
 console = Console()
+# One client for planning and execution so both share the HTTP connection pool
+client = ollama.AsyncClient(host=os.environ.get("OLLAMA_HOST", "http://localhost:11434"))
+# Keep the model loaded between calls and runs so its weights and prompt cache stay warm
+KEEP_ALIVE = "1h"
+
+async def warm_up():
+    """Load the model ahead of the first request with a one-token generation."""
+    await client.generate(model='llama3.1:8b', prompt=' ', keep_alive=KEEP_ALIVE, options={'num_predict': 1})
+
+# Anything a plain argv exec would not interpret the way a shell does
+SHELL_SYNTAX = re.compile(r"[|&;<>$`()\n#*?\[\]{}~]")
+
+def shell_free_argv(command: str):
+    """Return command as an argv list if it can run without a shell, otherwise None."""
+    if SHELL_SYNTAX.search(command):
+        return None
+    try:
+        argv = shlex.split(command)
+    except ValueError:
+        return None
+    # Builtins, keywords and VAR=value prefixes only exist inside a shell
+    if not argv or '=' in argv[0] or shutil.which(argv[0]) is None:
+        return None
+    return argv
 
 # Define available tools
-def run_shell_command(command: str):
+async def run_shell_command(command: str):
     """
     Execute a shell command and return its output.
 
@@ -22,13 +53,26 @@ def run_shell_command(command: str):
         str: The output of the command, or an error message.
     """
     try:
-        result = subprocess.run(command, shell=True, capture_output=True, text=True, timeout=30)
-        if result.returncode == 0:
-            return result.stdout.strip()
+        argv = shell_free_argv(command)
+        pipes = dict(stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, start_new_session=True)
+        if argv:
+            process = await asyncio.create_subprocess_exec(*argv, **pipes)
         else:
-            return f"Error: {result.stderr.strip()}"
-    except subprocess.TimeoutExpired:
-        return "action execution failed with timeout"
+            process = await asyncio.create_subprocess_shell(command, **pipes)
+        try:
+            stdout, stderr = await asyncio.wait_for(process.communicate(), timeout=30)
+        except asyncio.TimeoutError:
+            # The command runs in its own session, so this also reaps anything it spawned
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            await process.wait()
+            return "action execution failed with timeout"
+        if process.returncode == 0:
+            return stdout.decode('utf-8', 'replace').strip()
+        else:
+            return f"Error: {stderr.decode('utf-8', 'replace').strip()}"
     except Exception as e:
         return f"Exception: {str(e)}"
 
@@ -37,9 +81,22 @@ TOOLS = {
     "run_shell_command": run_shell_command
 }
 
-SYSTEM_PROMPT_PLANNING = """You are a helpful AI assistant.
-Create a concise, step-by-step plan to answer the user's question.
-Output ONLY the plan as a numbered list. Do not execute any actions yet."""
+# Tool schema, built once and passed unchanged on every call.
+# The chat template renders it into every prompt, so it is kept to what the model needs.
+TOOL_SCHEMA = (
+    {
+        'type': 'function',
+        'function': {
+            'name': 'run_shell_command',
+            'description': 'Run a shell command and return its output.',
+            'parameters': {
+                'type': 'object',
+                'properties': {'command': {'type': 'string'}},
+                'required': ['command'],
+            },
+        },
+    },
+)
 
 SYSTEM_PROMPT_ACTING = """You are a helpful AI assistant that uses tools to answer questions.
 
@@ -52,50 +109,167 @@ Follow this pattern:
 4. Continue with more tool calls if needed
 5. Provide final answer when you have enough information"""
 
-def run_agent(query, max_steps=10):
-    """Main agent loop using ReAct pattern with explicit planning phase."""
-
-    # Define tools once for reuse
-    tools = [
-        {
-            'type': 'function',
-            'function': {
-                'name': 'run_shell_command',
-                'description': 'Execute a shell command and return its output.',
-                'parameters': {
-                    'type': 'object',
-                    'properties': {
-                        'command': {
-                            'type': 'string',
-                            'description': 'The shell command to execute.',
-                        },
-                    },
-                    'required': ['command'],
-                },
+# Structured output for the first turn: the plan plus the commands for its first step,
+# so planning does not cost a separate request
+PLAN_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'plan': {'type': 'array', 'items': {'type': 'string'}},
+        'tool_calls': {
+            'type': 'array',
+            'items': {
+                'type': 'object',
+                'properties': {'command': {'type': 'string'}},
+                'required': ['command'],
             },
         },
-    ]
+    },
+    'required': ['plan'],
+}
 
-    # PHASE 1: PLANNING (no tools available)
-    console.print(Rule("[bold blue]Step 1: Planning"))
+# Longest tool output passed on to the model; beyond it only the head and tail are kept
+MAX_OBSERVATION = 4000
 
-    planning_history = [
-        {"role": "system", "content": SYSTEM_PROMPT_PLANNING},
-        {"role": "user", "content": query}
-    ]
+def truncate_observation(observation):
+    """Keep the first and last MAX_OBSERVATION // 2 characters of a long observation."""
+    if len(observation) <= MAX_OBSERVATION:
+        return observation
+    half = MAX_OBSERVATION // 2
+    return observation[:half] + f"\n...[{len(observation) - MAX_OBSERVATION} characters elided]...\n" + observation[-half:]
 
-    with console.status("[bold green]Creating plan..."):
-        planning_response = ollama.chat(
-            model='llama3.1:8b',
-            messages=planning_history
-        )
+# Observations older than the most recent few are cut down before each step
+KEEP_FULL_OBSERVATIONS = 3
+OLD_OBSERVATION_CHARS = 500
+TRUNCATED_MARKER = "\n...[truncated]"
 
-    plan = planning_response['message']['content']
-    console.print(Panel(plan, title="Plan", border_style="cyan"))
+def compress_old_observations(execution_history):
+    """Shorten all but the most recent KEEP_FULL_OBSERVATIONS tool results in place.
+
+    Only the observation that has just aged out changes from one step to the next, so the
+    server re-evaluates a short tail instead of resending every full output ever seen.
+    """
+    tool_messages = [message for message in execution_history if message['role'] == 'tool']
+    for message in tool_messages[:-KEEP_FULL_OBSERVATIONS]:
+        # Already-shortened observations are exactly this long, so this runs once per message
+        if len(message['content']) > OLD_OBSERVATION_CHARS + len(TRUNCATED_MARKER):
+            message['content'] = message['content'][:OLD_OBSERVATION_CHARS] + TRUNCATED_MARKER
+
+# Programs that only read state; plain calls to them cannot affect each other and may run concurrently
+READ_ONLY_COMMANDS = frozenset({
+    "ls", "pwd", "cat", "head", "tail", "wc", "grep", "echo",
+    "uname", "whoami", "which", "stat", "df", "du", "ps",
+})
+
+def is_independent(tool_call):
+    """Return True if tool_call only reads state, so it can run alongside other such calls."""
+    if tool_call['function']['name'] not in TOOLS:
+        # Unknown tools fail without running anything
+        return True
+    argv = shell_free_argv(tool_call['function']['arguments'].get('command') or "")
+    return argv is not None and os.path.basename(argv[0]) in READ_ONLY_COMMANDS
+
+async def execute_tool_call(tool_call):
+    """Run a single tool call requested by the model and return its observation."""
+    function_name = tool_call['function']['name']
+    function_args = tool_call['function']['arguments']
+    if function_name not in TOOLS:
+        return f"Error: Unknown tool: {function_name}"
+    return truncate_observation(await TOOLS[function_name](function_args.get('command')))
+
+def command_view(command):
+    """Render a command for its action panel, highlighting only multi-line scripts."""
+    if "\n" not in command:
+        # A one-liner reads fine as plain text and skips the Pygments lexer
+        return Text(f"$ {command}")
+    return Syntax(command, "bash", theme="monokai", line_numbers=True)
+
+def start_independent_calls(tool_calls, running):
+    """Start tasks for the calls after those in running, as long as every call so far is independent.
+
+    running always covers a prefix of tool_calls: once a call may change state, it and every call
+    after it wait to be run in order by run_tool_calls.
+    """
+    while len(running) < len(tool_calls) and is_independent(tool_calls[len(running)]):
+        running.append(asyncio.create_task(execute_tool_call(tool_calls[len(running)])))
+
+async def run_tool_calls(tool_calls, execution_history, live, running=None):
+    """Show the requested actions, run them and append their results to history.
+
+    While the calls run they are shown in the live region; once done, actions and
+    observations are printed above it so they stay in the scrollback.
+
+    Calls run in the order given; a leading run of read-only calls runs concurrently.
+    running holds the tasks already started for a prefix of tool_calls, if any.
+    """
+    if running is None:
+        running = []
+        start_independent_calls(tool_calls, running)
 
-    # PHASE 2: EXECUTION (with tools)
-    # Start fresh history for execution with the acting system prompt
-    # Add few-shot examples to guide proper tool calling
+    actions = []
+    for tool_call in tool_calls:
+        function_name = tool_call['function']['name']
+        if function_name in TOOLS:
+            command_to_run = tool_call['function']['arguments'].get('command')
+            actions.append(Panel(command_view(command_to_run), title=f"Action: {function_name}", border_style="dark_orange"))
+    live.update(Group(*actions, Spinner("dots", text="[bold green]Running...")))
+
+    observations = await asyncio.gather(*running)
+    for tool_call in tool_calls[len(running):]:
+        observations.append(await execute_tool_call(tool_call))
+
+    # Results go into history in the order the model asked for them
+    results = []
+    for tool_call, observation in zip(tool_calls, observations):
+        if tool_call['function']['name'] in TOOLS:
+            results.append(Panel(observation, title="Observation", border_style="green"))
+        else:
+            results.append(Panel(observation, title="Error", border_style="bold red"))
+        execution_history.append({'role': 'tool', 'content': observation})
+    live.update(Group())
+    live.console.print(*actions, *results)
+
+async def stream_step(execution_history, live):
+    """Stream one model turn into the live region, starting tool calls as soon as they arrive.
+
+    The finished thought is printed above the live region, so it stays in the scrollback.
+
+    Returns the assistant message and the tasks already running a prefix of its tool calls.
+    """
+    parts = []
+    tool_calls = []
+    running = []
+    live.update(Spinner("dots", text="[bold green]Thinking..."))
+    stream = await client.chat(
+        model='llama3.1:8b',
+        messages=execution_history,
+        tools=TOOL_SCHEMA,
+        keep_alive=KEEP_ALIVE,
+        stream=True,
+    )
+    async for chunk in stream:
+        message = chunk['message']
+        if message.get('content'):
+            parts.append(message['content'])
+            # Only swaps the renderable; Live redraws it on its own refresh tick
+            live.update(Panel("".join(parts), title="Thought", border_style="yellow"))
+        # Ollama sends tool calls as complete objects; launch read-only ones while the rest streams in
+        tool_calls.extend(message.get('tool_calls') or [])
+        start_independent_calls(tool_calls, running)
+
+    assistant_message = {'role': 'assistant', 'content': "".join(parts)}
+    live.update(Group())
+    if parts:
+        live.console.print(Panel(assistant_message['content'], title="Thought", border_style="yellow"))
+    if tool_calls:
+        assistant_message['tool_calls'] = tool_calls
+    return assistant_message, running
+
+async def run_agent(query, max_steps=10, console=console):
+    """Main agent loop using ReAct pattern, with planning folded into the first step."""
+
+    # Acting system prompt with few-shot examples to guide proper tool calling
+    # Only append to this list (apart from shortening old observations): an unchanged prefix
+    # lets Ollama reuse its KV cache every step
     execution_history = [
         {"role": "system", "content": SYSTEM_PROMPT_ACTING},
         # Few-shot example 1: Show correct tool usage
@@ -115,61 +289,109 @@ def run_agent(query, max_steps=10):
         {"role": "tool", "content": "/home/user/projects"},
         {"role": "assistant", "content": "The current directory is /home/user/projects"},
         # Now the actual query
-        {"role": "user", "content": f"Original question: {query}\n\nPlan to follow:\n{plan}\n\nNow execute this plan using available tools."}
+        {"role": "user", "content": f"Original question: {query}\n\nFirst make a concise, step-by-step plan to answer it, then give the shell commands for the first step of the plan."}
     ]
 
-    for step in range(2, max_steps + 1):
-        console.print(Rule(f"[bold blue]Step {step}"))
-
-        # Call model with tools available
-        with console.status("[bold green]Thinking..."):
-            response = ollama.chat(
-                model='llama3.1:8b',
-                messages=execution_history,
-                tools=tools,
-            )
-
-        assistant_message = response.get('message', {})
-        execution_history.append(assistant_message)
-
-        # Display reasoning if present
-        if assistant_message.get('content'):
-            console.print(Panel(assistant_message['content'], title="Thought", border_style="yellow"))
-
-        # Check for tool calls
-        tool_calls = assistant_message.get('tool_calls')
-        if tool_calls:
-            # Execute each tool call
-            for tool_call in tool_calls:
-                function_name = tool_call['function']['name']
-                function_args = tool_call['function']['arguments']
-
-                if function_name in TOOLS:
-                    command_to_run = function_args.get('command')
-                    syntax = Syntax(command_to_run, "bash", theme="monokai", line_numbers=True)
-                    console.print(Panel(syntax, title=f"Action: {function_name}", border_style="dark_orange"))
-
-                    observation = TOOLS[function_name](command_to_run)
-                    console.print(Panel(observation, title="Observation", border_style="green"))
-
-                    execution_history.append({'role': 'tool', 'content': observation})
-                else:
-                    error_msg = f"Error: Unknown tool: {function_name}"
-                    console.print(Panel(error_msg, title="Error", border_style="bold red"))
-                    execution_history.append({'role': 'tool', 'content': error_msg})
+    # One live region for whatever is in progress; finished panels are printed above it, so the whole
+    # trace stays in the scrollback (and in piped output) while only the current step is redrawn
+    # A quiet console (batch mode) draws nothing, so it gets no refresh thread either
+    with Live(console=console, refresh_per_second=10, transient=True, auto_refresh=not console.quiet) as live:
+        console.print(Rule("[bold blue]Step 1: Planning"))
+        # Costs one token when the model is already resident, a single load otherwise
+        live.update(Spinner("dots", text="[bold green]Loading model..."))
+        await warm_up()
+
+        # PHASE 1: PLANNING, merged with the first action into one structured response
+        live.update(Spinner("dots", text="[bold green]Creating plan..."))
+        planning_response = await client.chat(
+            model='llama3.1:8b',
+            messages=execution_history,
+            format=PLAN_SCHEMA,
+            keep_alive=KEEP_ALIVE,
+        )
+
+        try:
+            planning_output = orjson.loads(planning_response['message']['content'])
+        except orjson.JSONDecodeError:
+            planning_output = {'plan': [planning_response['message']['content']]}
+
+        plan = "\n".join(f"{number}. {item}" for number, item in enumerate(planning_output.get('plan', []), start=1))
+        live.update(Group())
+        console.print(Panel(plan, title="Plan", border_style="cyan"))
+
+        # Record the first step as a native tool-calling turn so the following steps continue from it
+        first_tool_calls = [
+            {"function": {"name": "run_shell_command", "arguments": {"command": call['command']}}}
+            for call in planning_output.get('tool_calls', [])
+        ]
+        planning_message = {"role": "assistant", "content": plan}
+        if first_tool_calls:
+            planning_message["tool_calls"] = first_tool_calls
+        execution_history.append(planning_message)
+
+        if first_tool_calls:
+            await run_tool_calls(first_tool_calls, execution_history, live)
         else:
-            # No tool calls - model has reached final answer
-            final_answer = assistant_message.get('content', "Task completed.")
-            console.print(Panel(final_answer, title="Final Answer", border_style="sky_blue1"))
-            return final_answer
+            execution_history.append({"role": "user", "content": "Now execute this plan using available tools."})
+
+        # PHASE 2: EXECUTION (with tools)
+
+        final_answer = None
+        for step in range(2, max_steps + 1):
+            console.print(Rule(f"[bold blue]Step {step}"))
+            compress_old_observations(execution_history)
+
+            # Call model with tools available; its reasoning streams into the live region
+            assistant_message, running = await stream_step(execution_history, live)
+            execution_history.append(assistant_message)
+
+            # Check for tool calls
+            tool_calls = assistant_message.get('tool_calls')
+            if tool_calls:
+                await run_tool_calls(tool_calls, execution_history, live, running)
+            else:
+                # No tool calls - model has reached final answer
+                final_answer = assistant_message.get('content', "Task completed.")
+                break
+
+    if final_answer is None:
+        return "Max steps reached without final answer."
+    console.print(Panel(final_answer, title="Final Answer", border_style="sky_blue1"))
+    return final_answer
+
+async def run_agent_batch(queries, concurrency=8):
+    """Run the agent on many queries against the same Ollama server, at most concurrency at a time.
+
+    Traces are not rendered, since concurrent runs would interleave them; answers come back in query order,
+    with the exception in place of the answer for a query that failed.
+    Start the server with OLLAMA_NUM_PARALLEL >= concurrency so it batches the requests.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run_one(query):
+        async with semaphore:
+            # Each run gets its own console: rich allows one live display per console
+            return await run_agent(query, console=Console(quiet=True))
 
-    return "Max steps reached without final answer."
+    # One failing query must not discard the answers of the others
+    return await asyncio.gather(*(run_one(query) for query in queries), return_exceptions=True)
 
 if __name__ == "__main__":
-    if len(sys.argv) > 1:
+    if len(sys.argv) > 2 and sys.argv[1] == "--batch":
+        with open(sys.argv[2]) as queries_file:
+            queries = [line.strip() for line in queries_file if line.strip()]
+        results = asyncio.run(run_agent_batch(queries))
+        for query, result in zip(queries, results):
+            console.print(Rule(f"[bold magenta]{query}"))
+            if isinstance(result, Exception):
+                console.print(Panel(f"{type(result).__name__}: {result}", title="Error", border_style="bold red"))
+            else:
+                console.print(result)
+    elif len(sys.argv) > 1:
         query = sys.argv[1]
-        result = run_agent(query)
+        result = asyncio.run(run_agent(query))
         console.print(Rule("[bold magenta]Result"))
         console.print(result)
     else:
         print("Usage: python 7.agent-uses-model-tool-calling.py 'your query'")
+        print("       python 7.agent-uses-model-tool-calling.py --batch queries.txt")
@@ -1,14 +1,68 @@
+import os
+import select
+import shlex
+import signal
 import subprocess
 import sys
-import json
+import threading
+import time
+import uuid
+import orjson
 from llama_cpp import Llama
 from rich.console import Console
 from rich.panel import Panel
 from rich.syntax import Syntax
+from rich.text import Text
 from rich.rule import Rule
 
 console = Console()
 
+# One long-lived bash serves every tool call, so commands don't pay for a shell start-up each
+shell = None
+shell_lock = threading.Lock()
+# Printed after each command to find where its output ends
+SHELL_MARKER = f"__agent_command_done_{uuid.uuid4().hex}__".encode()
+
+def start_shell():
+    """Start the persistent bash process in its own process group."""
+    return subprocess.Popen(
+        ["/bin/bash", "-s"],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        bufsize=0,
+        start_new_session=True,
+    )
+
+def read_command_output(process, timeout):
+    """Read the shell's stdout and stderr up to the end markers; return (stdout, stderr, exit code)."""
+    stdout_fd, stderr_fd = process.stdout.fileno(), process.stderr.fileno()
+    buffers = {stdout_fd: bytearray(), stderr_fd: bytearray()}
+    stdout_end = b"\n" + SHELL_MARKER + b" "
+    stderr_end = b"\n" + SHELL_MARKER + b"\n"
+    pending = {stdout_fd, stderr_fd}
+    deadline = time.monotonic() + timeout
+
+    while pending:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise subprocess.TimeoutExpired("run_shell_command", timeout)
+        ready, _, _ = select.select(list(pending), [], [], remaining)
+        for fd in ready:
+            data = os.read(fd, 65536)
+            if not data:
+                raise RuntimeError("persistent shell exited unexpectedly")
+            buffer = buffers[fd]
+            buffer += data
+            if fd == stdout_fd and buffer.endswith(b"\n") and stdout_end in buffer:
+                pending.discard(fd)
+            elif fd == stderr_fd and buffer.endswith(stderr_end):
+                pending.discard(fd)
+
+    stdout, _, status = bytes(buffers[stdout_fd]).rpartition(stdout_end)
+    stderr = bytes(buffers[stderr_fd])[:-len(stderr_end)]
+    return stdout, stderr, int(status)
+
 # Define available tools
 def run_shell_command(command: str):
     """
@@ -20,22 +74,55 @@ def run_shell_command(command: str):
     Returns:
         str: The output of the command, or an error message.
     """
-    try:
-        result = subprocess.run(command, shell=True, capture_output=True, text=True, timeout=30)
-        if result.returncode == 0:
-            return result.stdout.strip()
-        else:
-            return f"Error: {result.stderr.strip()}"
-    except subprocess.TimeoutExpired:
-        return "action execution failed with timeout"
-    except Exception as e:
-        return f"Exception: {str(e)}"
+    global shell
+    with shell_lock:
+        try:
+            if shell is None or shell.poll() is not None:
+                shell = start_shell()
+            # A subshell keeps commands isolated from each other and survives `exit` or
+            # syntax errors; unlike a fresh /bin/sh it is only a fork, with no exec or start-up
+            marker = SHELL_MARKER.decode()
+            shell.stdin.write(
+                f"( eval {shlex.quote(command)} ) < /dev/null\n"
+                f"printf '\\n%s %d\\n' {marker} $?\n"
+                f"printf '\\n%s\\n' {marker} >&2\n".encode()
+            )
+            stdout, stderr, returncode = read_command_output(shell, timeout=30)
+            if returncode == 0:
+                return stdout.decode('utf-8', 'replace').strip()
+            else:
+                return f"Error: {stderr.decode('utf-8', 'replace').strip()}"
+        except subprocess.TimeoutExpired:
+            # Kill the shell together with whatever it is still running; the next call starts a new one
+            os.killpg(shell.pid, signal.SIGKILL)
+            shell.wait()
+            shell = None
+            return "action execution failed with timeout"
+        except Exception as e:
+            return f"Exception: {str(e)}"
 
 # Map tool names to their actual functions for execution
 TOOLS = {
     "run_shell_command": run_shell_command
 }
 
+# Longest tool output passed on to the model; beyond it only the head and tail are kept
+MAX_OBSERVATION = 4000
+
+def truncate_observation(observation):
+    """Keep the first and last MAX_OBSERVATION // 2 characters of a long observation."""
+    if len(observation) <= MAX_OBSERVATION:
+        return observation
+    half = MAX_OBSERVATION // 2
+    return observation[:half] + f"\n...[{len(observation) - MAX_OBSERVATION} characters elided]...\n" + observation[-half:]
+
+def command_view(command):
+    """Render a command for its action panel, highlighting only multi-line scripts."""
+    if "\n" not in command:
+        # A one-liner reads fine as plain text and skips the Pygments lexer
+        return Text(f"$ {command}")
+    return Syntax(command, "bash", theme="monokai", line_numbers=True)
+
 # Tool schema for llama-cpp
 TOOL_SCHEMA = [
     {
@@ -162,11 +249,11 @@ def run_agent(llm, query, max_steps=10):
         # Try to parse content as a tool call
         parsed_tool_call = None
         try:
-            parsed = json.loads(content.strip())
+            parsed = orjson.loads(content.strip())
             if isinstance(parsed, dict) and "name" in parsed:
                 # This is a tool call in JSON format (Llama 3.1 native format)
                 parsed_tool_call = parsed
-        except json.JSONDecodeError:
+        except orjson.JSONDecodeError:
             # Not JSON - this is a regular text response, model is done with tools
             pass
 
@@ -178,10 +265,9 @@ def run_agent(llm, query, max_steps=10):
 
             if function_name in TOOLS:
                 command_to_run = function_args.get("command", "")
-                syntax = Syntax(command_to_run, "bash", theme="monokai", line_numbers=True)
-                console.print(Panel(syntax, title=f"Action: {function_name}", border_style="dark_orange"))
+                console.print(Panel(command_view(command_to_run), title=f"Action: {function_name}", border_style="dark_orange"))
 
-                observation = TOOLS[function_name](command_to_run)
+                observation = truncate_observation(TOOLS[function_name](command_to_run))
                 console.print(Panel(observation, title="Observation", border_style="green"))
 
                 # Add tool call and result to history